@@ -0,0 +1,334 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pymysql
+
+from xserver_dbhelper import xserver_db_connect
+from xserver_dbhelper.xserver_db_connect import DBHelper, NotDBSettingJsonFile
+
+SETTINGS = {
+    "db_host": "localhost",
+    "db_user": "user",
+    "db_password": "password",
+    "ssh_pkey_name": "id_rsa",
+    "ssh_host": "example.xsrv.jp",
+    "ssh_port": "10022",
+    "ssh_user": "ssh_user",
+    "ssh_pkey_pass": "pass",
+    "ssh_mysql_host": "127.0.0.1",
+    "ssh_mysql_port": "3306",
+}
+
+
+class RecordingCursor(pymysql.cursors.Cursor):
+    """サーバーへ送信する代わりにSQL文を記録するカーソル
+    """
+
+    def execute(self, query, args=None):
+        if args is not None:
+            query = self.mogrify(query, args)
+        if isinstance(query, str):
+            query = query.encode("utf8")
+        self.connection.executed.append(bytes(query))
+        self._executed = query
+        self._rows = ()
+        # VALUES句の行数を更新件数とする（それ以外の文は1件）
+        return max(query.count(b"('"), 1)
+
+
+def _escape(value, *args):
+    return "'%s'" % value
+
+
+def make_connection():
+    con = mock.MagicMock()
+    con.encoding = "utf8"
+    con.escape = con.literal = _escape
+    con.executed = []
+    con.cursor.side_effect = lambda cursorclass=None: RecordingCursor(con)
+    return con
+
+
+class DBHelperTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "settings.json")
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(SETTINGS, f)
+        self.helper = DBHelper("db", self.path)
+        self.con = make_connection()
+        self.helper.con = self.con
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+class SettingsTest(DBHelperTestCase):
+
+    def write(self, text):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(text)
+        # 更新時刻の精度が粗いファイルシステムでも読み直させる
+        xserver_db_connect._CONFIG_CACHE.clear()
+
+    def test_cached_settings_are_not_reread(self):
+        with mock.patch("builtins.open", side_effect=AssertionError("reopened")):
+            helper = DBHelper("db", self.path)
+        self.assertEqual(helper.db_user, "user")
+
+    def test_rewritten_settings_are_reloaded(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(dict(SETTINGS, db_user="other"), f)
+        st = os.stat(self.path)
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertEqual(DBHelper("db", self.path).db_user, "other")
+        keys = [k for k in xserver_db_connect._CONFIG_CACHE if k[0] == self.path]
+        self.assertEqual(keys, [(self.path, st.st_mtime_ns + 1000000000)])
+
+    def test_missing_file(self):
+        with self.assertRaises(NotDBSettingJsonFile) as cm:
+            DBHelper("db", os.path.join(self.dir, "missing.json"))
+        self.assertIsInstance(cm.exception.__cause__, FileNotFoundError)
+
+    def test_none_path(self):
+        with self.assertRaises(NotDBSettingJsonFile) as cm:
+            DBHelper("db", None)
+        self.assertIsNotNone(cm.exception.__cause__)
+
+    def test_invalid_json_propagates(self):
+        self.write("{")
+        with self.assertRaises(json.JSONDecodeError):
+            DBHelper("db", self.path)
+
+    def test_missing_key_propagates(self):
+        settings = dict(SETTINGS)
+        del settings["db_user"]
+        self.write(json.dumps(settings))
+        with self.assertRaises(KeyError):
+            DBHelper("db", self.path)
+
+    def test_bad_port_propagates(self):
+        self.write(json.dumps(dict(SETTINGS, ssh_port="ssh")))
+        with self.assertRaises(ValueError):
+            DBHelper("db", self.path)
+
+
+class ExecuteManyTest(DBHelperTestCase):
+
+    sql = "INSERT INTO TABLE1 (CODE, NAME) VALUES (%s, %s)"
+
+    def test_chunks_by_batch_size(self):
+        rows = [("%04d" % i, "name") for i in range(5)]
+        self.helper.executemany(self.sql, rows, batch_size=2)
+        self.assertEqual([q.count(b"('") for q in self.con.executed], [2, 2, 1])
+        for q in self.con.executed:
+            self.assertTrue(q.startswith(b"INSERT INTO TABLE1 (CODE, NAME) VALUES "))
+        self.con.commit.assert_called_once_with()
+
+    def test_chunks_by_encoded_length(self):
+        rows = [("%04d" % i, "佐藤" * 10) for i in range(4)]
+        cur = self.helper._exec_cursor
+        value = cur.mogrify("(%s, %s)", rows[0]).encode("utf8")
+        prefix = b"INSERT INTO TABLE1 (CODE, NAME) VALUES "
+        # 文字数なら2行入るが、バイト数では1行しか入らない長さ
+        cur.max_stmt_length = len(prefix) + len(value) * 2
+        self.assertLess(len(prefix) + 2 * len(value.decode("utf8")) + 1, cur.max_stmt_length)
+        self.helper.executemany(self.sql, rows)
+        self.assertEqual(len(self.con.executed), 4)
+        for q in self.con.executed:
+            self.assertLessEqual(len(q), cur.max_stmt_length)
+
+    def test_small_rows_are_not_split_by_default(self):
+        rows = [("%04d" % i, "name") for i in range(5000)]
+        cur = self.helper._exec_cursor
+        self.helper.executemany(self.sql, rows)
+        # max_stmt_lengthに収まるので1回で送信される
+        self.assertLess(len(self.con.executed[0]), cur.max_stmt_length)
+        self.assertEqual(len(self.con.executed), 1)
+        self.assertEqual(sum(q.count(b"('") for q in self.con.executed), 5000)
+
+    def test_on_duplicate_postfix(self):
+        sql = self.sql + " ON DUPLICATE KEY UPDATE NAME = VALUES(NAME)"
+        rows = [("0010", "佐藤"), ("0020", "高橋"), ("0030", "鈴木")]
+        self.helper.executemany(sql, rows, batch_size=2)
+        self.assertEqual(len(self.con.executed), 2)
+        for q in self.con.executed:
+            self.assertTrue(q.endswith(b" ON DUPLICATE KEY UPDATE NAME = VALUES(NAME)"))
+            self.assertEqual(q.count(b"ON DUPLICATE"), 1)
+
+    def test_non_insert_falls_back_to_row_by_row(self):
+        sql = "UPDATE TABLE1 SET NAME = %s WHERE CODE = %s"
+        rows = [("佐藤", "0010"), ("高橋", "0020"), ("鈴木", "0030")]
+        result = self.helper.executemany(sql, rows, batch_size=2)
+        self.assertEqual(self.con.executed, [
+            "UPDATE TABLE1 SET NAME = '佐藤' WHERE CODE = '0010'".encode("utf8"),
+            "UPDATE TABLE1 SET NAME = '高橋' WHERE CODE = '0020'".encode("utf8"),
+            "UPDATE TABLE1 SET NAME = '鈴木' WHERE CODE = '0030'".encode("utf8"),
+        ])
+        self.assertEqual(result, 3)
+
+    def test_returns_row_count(self):
+        rows = [("%04d" % i, "name") for i in range(7)]
+        self.assertEqual(self.helper.executemany(self.sql, rows, batch_size=3), 7)
+
+    def test_empty_list(self):
+        self.assertEqual(self.helper.executemany(self.sql, []), 0)
+        self.assertEqual(self.con.executed, [])
+
+
+class ExecuteTest(DBHelperTestCase):
+
+    def test_returns_row_count(self):
+        sql = "INSERT INTO TABLE1 (CODE, NAME) VALUES (%s, %s)"
+        self.assertEqual(self.helper.execute(sql, ("0010", "佐藤")), 1)
+        self.con.commit.assert_called_once_with()
+
+    def test_lastrowid_comes_from_exec_cursor(self):
+        self.assertIsNone(self.helper.lastrowid)
+        self.helper.execute("INSERT INTO TABLE1 (CODE) VALUES (%s)", ("0010",))
+        self.helper._exec_cursor.lastrowid = 42
+        self.helper.fetch("SELECT 1")
+        self.assertEqual(self.helper.lastrowid, 42)
+
+
+class TransactionTest(DBHelperTestCase):
+
+    sql = "INSERT INTO TABLE1 (CODE, NAME) VALUES (%s, %s)"
+
+    def test_commits_once(self):
+        with self.helper.transaction():
+            self.helper.execute(self.sql, ("0010", "佐藤"))
+            self.helper.executemany(self.sql, [("0020", "高橋")])
+        self.con.begin.assert_called_once_with()
+        self.con.commit.assert_called_once_with()
+
+    def test_nested_joins_outer_transaction(self):
+        with self.helper.transaction():
+            with self.helper.transaction():
+                self.helper.execute(self.sql, ("0010", "佐藤"))
+            self.helper.execute(self.sql, ("0020", "高橋"))
+            self.con.commit.assert_not_called()
+        self.con.begin.assert_called_once_with()
+        self.con.commit.assert_called_once_with()
+
+    def test_nested_exception_rolls_back_outer(self):
+        with self.assertRaises(ValueError):
+            with self.helper.transaction():
+                with self.helper.transaction():
+                    raise ValueError()
+        self.con.rollback.assert_called_once_with()
+        self.con.commit.assert_not_called()
+        self.assertFalse(self.helper._in_txn)
+
+
+class PoolTest(DBHelperTestCase):
+
+    def setUp(self):
+        super().setUp()
+        xserver_db_connect._POOL.clear()
+        patcher = mock.patch.object(xserver_db_connect, "SSHTunnelForwarder")
+        self.forwarder = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(xserver_db_connect.pymysql, "connect", side_effect=lambda **kw: make_connection())
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        xserver_db_connect._POOL.clear()
+        super().tearDown()
+
+    def test_clean_exit_rolls_back_and_reuses_connection(self):
+        with DBHelper("db", self.path) as helper:
+            con = helper.con
+        con.rollback.assert_called_once_with()
+        self.assertIsNone(helper.con)
+        with DBHelper("db", self.path) as helper:
+            self.assertIs(helper.con, con)
+        self.assertEqual(self.connect.call_count, 1)
+        self.assertEqual(self.forwarder.call_count, 1)
+
+    def test_close_is_idempotent(self):
+        helper = DBHelper("db", self.path)
+        helper.connect()
+        helper.close()
+        helper.close()
+        with helper:
+            pass
+        helper.close()
+        (_, connections), = xserver_db_connect._POOL.values()
+        self.assertEqual(connections.qsize(), 1)
+
+    def test_failed_rollback_keeps_original_exception(self):
+        with self.assertRaises(ValueError):
+            with DBHelper("db", self.path) as helper:
+                con = helper.con
+                con.rollback.side_effect = pymysql.err.OperationalError()
+                raise ValueError()
+        con.close.assert_called_once_with()
+        (_, connections), = xserver_db_connect._POOL.values()
+        self.assertTrue(connections.empty())
+
+    def test_pool_key_includes_credentials(self):
+        other = os.path.join(self.dir, "other.json")
+        with open(other, "w", encoding="utf-8") as f:
+            json.dump(dict(SETTINGS, db_user="other"), f)
+        with DBHelper("db", self.path):
+            pass
+        with DBHelper("db", other):
+            self.assertEqual(self.connect.call_args.kwargs["user"], "other")
+        self.assertEqual(len(xserver_db_connect._POOL), 2)
+        self.assertEqual(self.connect.call_count, 2)
+
+    def test_inactive_tunnel_is_rebuilt(self):
+        with DBHelper("db", self.path) as helper:
+            dead = helper.server
+        dead.is_active = False
+        self.forwarder.return_value = mock.MagicMock(is_active=True)
+        with DBHelper("db", self.path) as helper:
+            self.assertIsNot(helper.server, dead)
+        dead.stop.assert_called_once_with()
+        self.assertEqual(self.connect.call_count, 2)
+
+    def test_connection_from_evicted_tunnel_is_closed(self):
+        helper = DBHelper("db", self.path)
+        helper.connect()
+        con, dead = helper.con, helper.server
+        dead.is_active = False
+        self.forwarder.return_value = mock.MagicMock(is_active=True)
+        with DBHelper("db", self.path):
+            pass
+        helper.close()
+        con.close.assert_called_once_with()
+        (_, connections), = xserver_db_connect._POOL.values()
+        self.assertEqual(connections.qsize(), 1)
+        self.assertIsNot(connections.get_nowait(), con)
+
+    def test_tunnel_starts_outside_pool_lock(self):
+        locked = []
+        self.forwarder.return_value.start.side_effect = lambda: locked.append(xserver_db_connect._POOL_LOCK.locked())
+        with DBHelper("db", self.path):
+            pass
+        self.assertEqual(locked, [False])
+
+    def test_close_releases_prewarmed_connection(self):
+        helper = DBHelper("db", self.path, eager=True)
+        helper.close()
+        self.assertIsNone(helper.con)
+        (_, connections), = xserver_db_connect._POOL.values()
+        self.assertEqual(connections.qsize(), 1)
+
+    def test_prewarm_error_is_raised_on_enter(self):
+        self.connect.side_effect = pymysql.err.OperationalError()
+        helper = DBHelper("db", self.path, eager=True)
+        with self.assertRaises(pymysql.err.OperationalError):
+            with helper:
+                pass
+
+
+if __name__ == "__main__":
+    unittest.main()
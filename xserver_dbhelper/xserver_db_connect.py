@@ -1,8 +1,83 @@
 from sshtunnel import SSHTunnelForwarder
 import pymysql
-import json
-from pandas import DataFrame
+# orjsonがインストールされていれば高速なパーサーを使う
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
 import os
+import operator
+import contextlib
+import itertools
+import queue
+import atexit
+import threading
+import logging
+import time
+from typing import TYPE_CHECKING
+from urllib.parse import quote
+
+# pandasはdataframe()を呼び出した時に読み込む
+if TYPE_CHECKING:
+    from pandas import DataFrame
+    from pyarrow import Table
+
+logger = logging.getLogger(__name__)
+
+#: dataframeでサーバーから1回に受け取る行数
+DATAFRAME_FETCH_SIZE = 10000
+
+#: (設定ファイルのパス, 更新時刻) -> 読み込み済みの設定
+_CONFIG_CACHE = {}
+
+#: 設定ファイルから取り出す項目
+_CONFIG_KEYS = operator.itemgetter(
+    "db_host",
+    "db_user",
+    "db_password",
+    "ssh_pkey_name",
+    "ssh_host",
+    "ssh_port",
+    "ssh_user",
+    "ssh_pkey_pass",
+    "ssh_mysql_host",
+    "ssh_mysql_port",
+)
+
+#: SSHトンネルの通信を圧縮するかどうか
+SSH_COMPRESSION = True
+
+#: 接続先ごとにプールしておくMysqlの接続数
+POOL_SIZE = 5
+
+#: 接続情報（DBHelper._pool_key） -> (SSHTunnelForwarder, 待機中の接続のQueue)
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+
+def _close_entry(server, connections):
+    """SSHトンネルと待機中のMysqlの接続を切断します。
+    """
+    while True:
+        try:
+            con = connections.get_nowait()
+        except queue.Empty:
+            break
+        # 切れている接続もあるので例外は無視する
+        with contextlib.suppress(Exception):
+            con.close()
+    with contextlib.suppress(Exception):
+        server.stop()
+
+def _close_pool():
+    """プールしているSSHトンネルとMysqlの接続をすべて切断します。
+    """
+    with _POOL_LOCK:
+        for server, connections in _POOL.values():
+            _close_entry(server, connections)
+        _POOL.clear()
+
+# インタプリタ終了時にプールを破棄する
+atexit.register(_close_pool)
 
 class NotDBSettingJsonFile(Exception):
     def __str__(self) -> str:
@@ -18,6 +93,7 @@ class DBHelper:
     Args:
         database (str, optional): データベース名。初期値はNone。
         db_setting_json_path (str, optional): 設定ファイルのパス文字列。 初期値はNone。
+        eager (bool, optional): Trueの場合、バックグラウンドで接続を開始しておく。初期値はFalse。
 
     Raises:
         NotDatabaseSet: データベースの設定が存在しない場合に発生。
@@ -62,15 +138,22 @@ class DBHelper:
         (b) -> int まとめてデータを更新
         
         >>> i = helper.executemany(sql, many_args)
+        
+        (c) -> まとめて1つのトランザクションで更新
+        
+        >>> with helper.transaction():
+                for args in many_args:
+                    helper.execute(sql, args)
             
     """
 
-    def __init__(self, database:str=None, db_setting_json_path:str=None):
+    def __init__(self, database:str=None, db_setting_json_path:str=None, eager:bool=False):
         """xserverのサーバー内のMysqlの操作機能を提供します
 
         Args:
             database (str, optional): データベース名。初期値はNone。
             db_setting_json_path (str, optional): 設定ファイルのパス文字列。 初期値はNone。
+            eager (bool, optional): Trueの場合、バックグラウンドで接続を開始しておく。初期値はFalse。
 
         Raises:
             NotDatabaseSet: データベースの設定が存在しない場合に発生。
@@ -115,6 +198,12 @@ class DBHelper:
             (b) -> int まとめてデータを更新
             
             >>> i = helper.executemany(sql, many_args)
+            
+            (c) -> まとめて1つのトランザクションで更新
+            
+            >>> with helper.transaction():
+                    for args in many_args:
+                        helper.execute(sql, args)
                 
         """
         # データベース名がNoneな場合例外を投げる
@@ -122,28 +211,66 @@ class DBHelper:
             raise NotDatabaseSet()
         else:
             self.db_name = database
+        
+        # transaction()の中ではexecute/executemanyでコミットしない
+        self._in_txn = False
+        
+        # 接続は__enter__でプールから取得する
+        self.server = None
+        self.con = None
+        self._connections = None
+        
+        # カーソルは最初に使う時に作成する
+        self._fetch_cur = None
+        self._exec_cur = None
             
-        # 設定ファイルの例外処理
+        # 設定ファイルのパスがNoneな場合例外を投げる
+        if db_setting_json_path is None:
+            raise NotDBSettingJsonFile() from ValueError("db_setting_json_path is None")
+        
+        t0 = time.perf_counter()
+        # 設定ファイルが読めない場合のみ例外を置き換え、JSONの書式や項目の誤りはそのまま投げる
         try:
-            
-            # JSONファイルからデータを受け取る
-            with open(db_setting_json_path, 'r', encoding='utf-8') as json_file:
-                json_data = json.load(json_file)
-            
-            # データベース設定を取り出す 
-            self.db_host = json_data[u"db_host"]
-            self.db_user = json_data[u"db_user"]
-            self.db_password = json_data[u"db_password"]
-            self.ssh_pkey = os.path.join(os.path.dirname(db_setting_json_path), json_data[u"ssh_pkey_name"])
-            self.ssh_host = json_data[u"ssh_host"]
-            self.ssh_port = int(json_data[u"ssh_port"])
-            self.ssh_user = json_data[u"ssh_user"]
-            self.ssh_pkey_pass = json_data[u"ssh_pkey_pass"]
-            self.ssh_mysql_host = json_data[u"ssh_mysql_host"]
-            self.ssh_mysql_port = int(json_data[u"ssh_mysql_port"])
-            
-        except Exception:
-            raise NotDBSettingJsonFile()
+            # 更新されていなければ読み込み済みの設定を使う
+            st = os.stat(db_setting_json_path)
+            key = (db_setting_json_path, st.st_mtime_ns)
+            json_data = _CONFIG_CACHE.get(key)
+            if json_data is None:
+                # JSONファイルからデータを受け取る
+                with open(db_setting_json_path, 'rb') as json_file:
+                    json_data = _json_loads(json_file.read())
+                # 同じファイルの古い設定は捨てる
+                for old_key in [k for k in _CONFIG_CACHE if k[0] == db_setting_json_path]:
+                    del _CONFIG_CACHE[old_key]
+                _CONFIG_CACHE[key] = json_data
+        except (FileNotFoundError, PermissionError) as e:
+            raise NotDBSettingJsonFile() from e
+        t1 = time.perf_counter()
+        logger.debug("config load time: %.3fms", (t1 - t0) * 1000)
+        
+        # データベース設定を取り出す 
+        (
+            self.db_host,
+            self.db_user,
+            self.db_password,
+            ssh_pkey_name,
+            self.ssh_host,
+            ssh_port,
+            self.ssh_user,
+            self.ssh_pkey_pass,
+            self.ssh_mysql_host,
+            ssh_mysql_port,
+        ) = _CONFIG_KEYS(json_data)
+        self.ssh_pkey = os.path.join(os.path.dirname(db_setting_json_path), ssh_pkey_name)
+        self.ssh_port = int(ssh_port)
+        self.ssh_mysql_port = int(ssh_mysql_port)
+    
+        # withブロックに入るまでにSSHトンネルとMysqlへ接続しておく
+        self._prewarm_thread = None
+        self._prewarm_error = None
+        if eager:
+            self._prewarm_thread = threading.Thread(target=self._prewarm, daemon=True)
+            self._prewarm_thread.start()
     
     def connect(self):
         """明示的にMysqlの接続を開始します。
@@ -151,16 +278,82 @@ class DBHelper:
         
         self.__enter__()
     
-    def __enter__(self):
-        # SShサーバーへ接続します
-        self.server = SSHTunnelForwarder(
+    @property
+    def _pool_key(self):
+        """プールのキー。接続先と認証情報が同じ場合のみ接続を共有します。
+        """
+        return (
+            self.ssh_host,
+            self.ssh_port,
+            self.ssh_user,
+            self.ssh_pkey,
+            self.ssh_mysql_host,
+            self.ssh_mysql_port,
+            self.db_host,
+            self.db_user,
+            self.db_password,
+            self.db_name,
+        )
+    
+    def _tunnel(self):
+        """プールからSSHトンネルを取得します。無い場合や切断されている場合は作成します。
+        
+        Returns:
+            tuple: (SSHTunnelForwarder, 待機中の接続のQueue)
+        """
+        key = self._pool_key
+        with _POOL_LOCK:
+            entry = _POOL.get(key)
+            if entry is not None and entry[0].is_active:
+                return entry
+        
+        # SSHの接続には時間がかかるので、ロックの外で行い他の接続先を待たせない
+        server = SSHTunnelForwarder(
             (self.ssh_host, self.ssh_port),
             ssh_username=self.ssh_user,
             ssh_private_key_password=self.ssh_pkey_pass,
             ssh_pkey=self.ssh_pkey,
             remote_bind_address=(self.ssh_mysql_host,self.ssh_mysql_port),
+            # 文字列の多い検索結果の転送量を減らす
+            compression=SSH_COMPRESSION,
         )
-        self.server.start()
+        server.start()
+        created = (server, queue.Queue(maxsize=POOL_SIZE))
+        
+        with _POOL_LOCK:
+            entry = _POOL.get(key)
+            if entry is not None and entry[0].is_active:
+                # 他のスレッドが先に作成した場合はそちらを使う
+                stale = created
+            else:
+                # 切断されたSSHトンネルはプールから外して入れ替える
+                stale = entry
+                entry = _POOL[key] = created
+        if stale is not None:
+            logger.debug("closing SSH tunnel to %s:%s", self.ssh_host, self.ssh_port)
+            _close_entry(*stale)
+        return entry
+    
+    def _acquire(self):
+        """プールからSSHトンネルとMysqlの接続を取得します。
+        """
+        self.server, self._connections = self._tunnel()
+        
+        # プールに待機中の接続があれば再利用する
+        while True:
+            try:
+                con = self._connections.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                con.ping(reconnect=True)
+            except Exception:
+                # 使えない接続は捨てて次を試す
+                with contextlib.suppress(Exception):
+                    con.close()
+                continue
+            self.con = con
+            return
         self.con = pymysql.connect(
             host=self.db_host,
             port=self.server.local_bind_port,
@@ -170,18 +363,98 @@ class DBHelper:
             # Select結果をタブルではなく辞書で受け取る
             cursorclass=pymysql.cursors.DictCursor
         )
-        self.cur = self.con.cursor()
+    
+    def _prewarm(self):
+        """バックグラウンドで接続を取得します。例外は__enter__で投げ直します。
+        """
+        try:
+            self._acquire()
+        except BaseException as e:
+            self._prewarm_error = e
+    
+    def __enter__(self):
+        if self._prewarm_thread is not None:
+            # バックグラウンドでの接続が終わるのを待つ
+            self._prewarm_thread.join()
+            self._prewarm_thread = None
+            if self._prewarm_error is not None:
+                error, self._prewarm_error = self._prewarm_error, None
+                raise error
+        else:
+            self._acquire()
         return self
         
     def __exit__(self, exc_type, exc_value, traceback):
-        self.con.close()
-        self.server.stop()
+        # 接続を返却済みの場合は何もしない
+        con, self.con = self.con, None
+        if con is None:
+            return
+        # プールへ戻す前に作成したカーソルを閉じる
+        for cur in (self._fetch_cur, self._exec_cur):
+            if cur is not None:
+                with contextlib.suppress(Exception):
+                    cur.close()
+        self._fetch_cur = None
+        self._exec_cur = None
+        # 未確定の更新とSELECTで開始したトランザクションを終了する
+        # （残したままプールへ戻すと、次の利用者が古いスナップショットを読んでしまう）
+        try:
+            con.rollback()
+        except Exception:
+            # 切れている接続はプールへ戻さずに捨てる（ブロック内の例外を隠さない）
+            logger.debug("rollback failed, discarding connection", exc_info=True)
+            with contextlib.suppress(Exception):
+                con.close()
+            return
+        # 接続はプールへ戻し、SSHトンネルは維持する
+        with _POOL_LOCK:
+            entry = _POOL.get(self._pool_key)
+            # SSHトンネルが作り直されている場合は古いQueueへ戻さない
+            if entry is not None and entry[1] is self._connections:
+                try:
+                    self._connections.put_nowait(con)
+                    return
+                except queue.Full:
+                    pass
+        con.close()
+        
+    @property
+    def _fetch_cursor(self):
+        """SELECT文用のカーソル（結果を辞書で受け取る）
+        """
+        if self._fetch_cur is None:
+            self._fetch_cur = self.con.cursor(pymysql.cursors.DictCursor)
+        return self._fetch_cur
+    
+    @property
+    def _exec_cursor(self):
+        """INSERT,UPDATE,DELETE文用のカーソル（結果をタプルで受け取る）
+        """
+        if self._exec_cur is None:
+            self._exec_cur = self.con.cursor(pymysql.cursors.Cursor)
+        return self._exec_cur
+    
+    @property
+    def lastrowid(self):
+        """直前のexecute/executemanyで追加したレコードのAUTO_INCREMENTの値
+        """
+        if self._exec_cur is None:
+            return None
+        return self._exec_cur.lastrowid
         
     def close(self):
         """明示的にMysqlの接続を切断します。
+        
+        Note:
+            接続はプールへ戻され、SSHトンネルはインタプリタ終了時に切断されます。
+            eager=Trueでバックグラウンドで取得した接続も、withブロックに入ったかどうかに関わらず返却します。
         """
-        self.con.close()
-        self.server.stop()
+        if self._prewarm_thread is not None:
+            # バックグラウンドでの接続が終わるのを待ってから返却する
+            self._prewarm_thread.join()
+            self._prewarm_thread = None
+            self._prewarm_error = None
+        self.__exit__(None, None, None)
         
     def fetch(self, sql:str, args=None) -> tuple:        
         """SQLクエリで抽出した全てのレコードを返却します。
@@ -200,16 +473,21 @@ class DBHelper:
                 args = ["0010", "佐藤"]
                 result = fetch(sql, args)
         """
-        self.cur.execute(sql, args)
-        result = self.cur.fetchall()
+        cur = self._fetch_cursor
+        cur.execute(sql, args)
+        result = cur.fetchall()
         return result
     
-    def fetchItem(self, sql:str, args=None) -> dict:
+    def fetchItem(self, sql:str, args=None, arraysize:int=1000) -> dict:
         """SQLクエリで抽出したレコードを1件ずつ返します。
+        
+        Note:
+            レコードはarraysize件ずつまとめて受け取り、1件ずつ返却します。
 
         Args:
             sql (str): SQLクエリ
             args : 置換文字列
+            arraysize (int, optional): 1回に受け取るレコード数。初期値は1000。
 
         Returns:
             dict: generator object DBHelper.fetchItem
@@ -226,16 +504,18 @@ class DBHelper:
 
         """
         # SQLクエリをリクエストする
-        self.cur.execute(sql, args)
+        cur = self._fetch_cursor
+        cur.execute(sql, args)
         # ループ処理
         while True:
-            # 1行ずつクエリ結果を取り出す。
-            result = self.cur.fetchone()            
+            # arraysize件ずつクエリ結果を取り出す。
+            chunk = cur.fetchmany(arraysize)
             # データが無くなったらループを抜ける
-            if result is None:
-                break            
+            if not chunk:
+                break
             # 1行ずつ結果を返却
-            yield result
+            for result in chunk:
+                yield result
 
     def execute(self, sql:str, args:tuple=None) -> int:
         """SQLクエリで1件のデータを更新します。
@@ -252,15 +532,22 @@ class DBHelper:
                 args = ["0010", "佐藤"]
                 i = excute(sql, args)
         """
-        self.cur.execute(sql, args)
-        self.con.commit()
+        rows = self._exec_cursor.execute(sql, args)
+        if not self._in_txn:
+            self.con.commit()
+        return rows
 
-    def executemany(self, sql:str, list:list) -> int:
+    def executemany(self, sql:str, list:list, batch_size:int=None) -> int:
         """SQLクエリでまとめてデータの更新を行います。
+        
+        Note:
+            pymysqlのexecutemanyへ渡します。INSERT/REPLACE文はpymysqlがSQL文の長さの上限まで複数行のVALUES句にまとめて送信します。
+            UPDATE,DELETE文などそれ以外のSQLクエリは1行ずつ送信します。
 
         Args:
             sql (str): SQLクエリ
             list (list): 更新データ
+            batch_size (int, optional): 1回の通信でまとめて送信する最大行数。初期値はNone（制限なし）。
 
         Returns:
             int: 更新件数
@@ -270,15 +557,110 @@ class DBHelper:
                 list = [["0010", "佐藤"], ["0020", "高橋"]]
                 i = executemany(sql, list)
         """
-        self.cur.executemany(sql, list)
-        self.con.commit()
+        cur = self._exec_cursor
+        
+        # 自動コミットを止めて、まとめて1回でコミットする
+        self.con.autocommit(False)
+        
+        # 行数の制限が無ければpymysqlにまとめて渡す
+        if batch_size is None:
+            rows = cur.executemany(sql, list) or 0
+            if not self._in_txn:
+                self.con.commit()
+            return rows
+        
+        rows = 0
+        it = iter(list)
+        while True:
+            # batch_size件ずつ取り出す
+            chunk = tuple(itertools.islice(it, batch_size))
+            if not chunk:
+                break
+            # SQL文の長さ（バイト数）の制限はpymysqlが守る
+            rows += cur.executemany(sql, chunk) or 0
+        if not self._in_txn:
+            self.con.commit()
+        return rows
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """ブロック内の更新を1つのトランザクションで行います。
+        
+        Note:
+            ブロック内のexecute/executemanyはコミットせず、ブロックを抜けた時にまとめてコミットします。
+            例外が発生した場合はロールバックします。
+            入れ子にした場合は、一番外側のブロックでのみ開始・コミット・ロールバックします。
+
+        Yields:
+            DBHelper: 自分自身
+        
+        Examples:
+            >>> sql = "INSERT INTO TABLE1 (CODE, NAME) VALUE (%s, %s)"
+                with helper.transaction():
+                    helper.execute(sql, ["0010", "佐藤"])
+                    helper.execute(sql, ["0020", "高橋"])
+        """
+        # 入れ子の場合は外側のトランザクションに含める
+        # （begin()を呼ぶとMysqlが外側のトランザクションを暗黙にコミットしてしまう）
+        if self._in_txn:
+            yield self
+            return
+        self.con.begin()
+        self._in_txn = True
+        try:
+            yield self
+        except BaseException:
+            self.con.rollback()
+            raise
+        else:
+            self.con.commit()
+        finally:
+            self._in_txn = False
+        
+    def fetch_arrow(self, sql:str, args=None) -> "Table":
+        """SQLクエリで抽出したすべてのレコードをArrowのTableで出力します。
+        
+        Note:
+            connectorxでSSHトンネルへ別に接続し、Pythonのオブジェクトを作らずに列形式で受け取ります。
+            connectorxとpyarrowのインストールが必要です。
+
+        Args:
+            sql (str): SQLクエリ
+            args (tuple): 置換文字列
+
+        Returns:
+            Table: レコードセット
+        
+        Examples:
+            >>> sql = "SELECT * FROM TABLE1 WHERE CODE = %s AND NAME = %s"
+                args = ["0010", "佐藤"]
+                table = fetch_arrow(sql, args)
+        """
+        import connectorx
+        
+        # connectorxはプレースホルダーに対応していないので、置換済みのSQLを渡す
+        if args is not None:
+            sql = self._exec_cursor.mogrify(sql, args)
+        url = "mysql://{}:{}@{}:{}/{}".format(
+            quote(self.db_user, safe=""),
+            quote(self.db_password, safe=""),
+            self.db_host,
+            self.server.local_bind_port,
+            self.db_name,
+        )
+        return connectorx.read_sql(url, sql, return_type="arrow")
         
-    def dataframe(self, sql:str, args=None) -> DataFrame:
+    def dataframe(self, sql:str, args=None, use_arrow:bool=False) -> "DataFrame":
         """SQLクエリで抽出したすべてのレコードをDataFrameで出力します。
+        
+        Note:
+            サーバー側カーソルで少しずつ受け取り、タプルのレコードからDataFrameを作成します。
+            use_arrowがTrueの場合は、fetch_arrowで受け取ったTableから変換します。
 
         Args:
             sql (str): SQLクエリ
             args (tuple): 置換文字列
+            use_arrow (bool, optional): Trueの場合、fetch_arrowを使う。初期値はFalse。
 
         Returns:
             DataFrame: レコードセット
@@ -288,7 +670,31 @@ class DBHelper:
                 args = ["0010", "佐藤"]
                 df = fetch(sql, args)
         """
-        df = DataFrame(self.fetch(sql, args))
+        # 列ごとのブロックのまま変換し、変換済みの列のArrowのメモリを解放する
+        # （self_destructで省メモリにするにはsplit_blocks=True, use_threads=Falseが必要）
+        if use_arrow:
+            return self.fetch_arrow(sql, args).to_pandas(
+                split_blocks=True, self_destruct=True, use_threads=False
+            )
+        
+        from pandas import DataFrame
+        
+        # 行ごとの辞書を作らないようにタプルのサーバー側カーソルを使う
+        cur = self.con.cursor(pymysql.cursors.SSCursor)
+        try:
+            cur.execute(sql, args)
+            names = [d[0] for d in cur.description]
+            rows = []
+            while True:
+                chunk = cur.fetchmany(DATAFRAME_FETCH_SIZE)
+                # データが無くなったらループを抜ける
+                if not chunk:
+                    break
+                rows.extend(chunk)
+        finally:
+            cur.close()
+        # 列名を指定してタプルから作成する（同名の列も残る）
+        df = DataFrame.from_records(rows, columns=names)
         return df
 
 if __name__ == "__main__":